@@ -2,4 +2,4 @@
 __version__ = "0.0.5"
 
 from cacao.components.generics import Composite
-from cacao.problems import SimulationProblem
\ No newline at end of file
+from cacao.problems import SimulationProblem, OptimizationProblem
\ No newline at end of file
@@ -0,0 +1,327 @@
+import hashlib
+import os
+import types
+
+from scipy.sparse import csc_matrix, csr_matrix
+
+import numpy as np
+
+import cacao
+from cacao.components.generics import Composite, Constant, Constraint, Variable
+
+def _fd_step(x):
+    # relative forward difference step, guarded for variables close to zero
+    return np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(x))
+
+def _fixed_mask(bnds):
+    return bnds.lb == bnds.ub
+
+# attributes of a block describing its place in the model, hashed separately by fingerprint
+_STRUCTURE_ATTRIBUTES = ('variables', 'parameters', 'constraints', 'parent', 'root', 'inlet', 'outlet')
+
+def _attributes(value):
+    # attributes of an object, from its __dict__ and its __slots__
+    attributes = dict(getattr(value, '__dict__', {}))
+    for cls in type(value).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(value, name):
+                attributes[name] = getattr(value, name)
+    return attributes
+
+def _is_plain(value):
+    return value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.number, np.ndarray, tuple))
+
+def _hash_value(digest, value, seen):
+    # hash the code of functions (with their constants, nested code and closure values), plain values and the attributes
+    # of other objects. Variables, constants and constraints only contribute their type, since their values do not
+    # change the structure of the model. seen maps the objects already hashed to their rank, so that an object met again
+    # (e.g a block of the model, or a cycle) contributes a reference to its first occurrence.
+    if not _is_plain(value):
+        if id(value) in seen:
+            digest.update(f'ref{seen[id(value)]}'.encode())
+            return
+        seen[id(value)] = len(seen)
+
+    if isinstance(value, types.FunctionType):
+        _hash_value(digest, value.__code__, seen)
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError: # empty cell
+                contents = None
+            _hash_value(digest, contents, seen)
+    elif isinstance(value, types.CodeType):
+        digest.update(value.co_code)
+        digest.update(repr(value.co_names).encode())
+        for const in value.co_consts:
+            _hash_value(digest, const, seen)
+    elif isinstance(value, np.ndarray):
+        digest.update(f'{value.dtype}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (tuple, list)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _hash_value(digest, item, seen)
+    elif isinstance(value, (set, frozenset)):
+        digest.update(repr(sorted(repr(item) for item in value)).encode())
+    elif isinstance(value, dict):
+        digest.update(f'dict{len(value)}'.encode())
+        for key, item in value.items():
+            _hash_value(digest, key, seen)
+            _hash_value(digest, item, seen)
+    elif _is_plain(value):
+        digest.update(repr(value).encode())
+    elif isinstance(value, type):
+        digest.update(f'{value.__module__}.{value.__qualname__}'.encode())
+    elif isinstance(value, types.ModuleType):
+        digest.update(value.__name__.encode())
+    else:
+        digest.update(f'{type(value).__module__}.{type(value).__qualname__}'.encode())
+        if not isinstance(value, (Constant, Variable, Constraint)):
+            for name, item in _attributes(value).items():
+                digest.update(name.encode())
+                _hash_value(digest, item, seen)
+
+def fingerprint(model):
+    """
+    Compute a fingerprint of the structure of a model: type of the blocks, connections between them, size of the
+    variables, variables fixed by the bounds, other attributes of the blocks (e.g an area or an index read by the
+    constraints) and code of the constraints, including their constants and the values they capture in closures. The
+    values of the variables, constants and parameters are left out: two models with the same fingerprint have the same
+    variable layout and the same jacobian sparsity, whatever these values.
+
+    :param model: The cacao model
+    :type model: cacao.components.generics.Composite
+
+    :return: Hexadecimal digest of the model structure.
+    :rtype: str
+    """
+    model = model.root
+    digest = hashlib.sha1()
+    digest.update(cacao.__version__.encode())
+    blocks = model.get_blocks()
+    index = {id(block): i for i, block in enumerate(blocks)}
+    # blocks and composites of the model are referred to by their rank when met in an attribute or a closure
+    seen = dict(index)
+    for composite in _composites(model):
+        seen[id(composite)] = len(seen)
+    for block in blocks:
+        digest.update(f'{type(block).__module__}.{type(block).__qualname__}'.encode())
+        for port in ('inlet', 'outlet'):
+            connected = [index.get(id(other), -1) for other in getattr(block, port, [])]
+            digest.update(f'{port}{connected}'.encode())
+        for variable in block.variables:
+            digest.update(f'var{len(variable.value)}'.encode())
+            digest.update((variable.lb == variable.ub).tobytes())
+        for name, value in sorted(vars(block).items()):
+            if name not in _STRUCTURE_ATTRIBUTES:
+                digest.update(name.encode())
+                _hash_value(digest, value, seen)
+        for constraint in block.constraints:
+            _hash_value(digest, constraint['rule'], seen)
+    return digest.hexdigest()
+
+def _composites(composite):
+    yield composite
+    for block in composite.blocks:
+        if isinstance(block, Composite):
+            yield from _composites(block)
+
+class CompiledModel:
+    """
+    The structure of a cacao model, as needed by the solvers: variable layout, free variables, sparsity pattern of the
+    constraints jacobian with respect to the free variables and a coloring of its columns (columns of the same color
+    have no row in common, hence can be perturbed together when approximating the jacobian by finite differences).
+
+    Use :func:`compile_model` to create it.
+    """
+    def __init__(self, sizes, free, rows, cols, colors, shape):
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.free = np.asarray(free, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.colors = np.asarray(colors, dtype=np.int64)
+        self.shape = tuple(int(n) for n in shape)
+
+        n_colors = self.colors.max() + 1 if len(self.colors) else 0
+        entry_colors = self.colors[self.cols]
+        self._groups = [np.flatnonzero(self.colors == c) for c in range(n_colors)]
+        self._entries = [np.flatnonzero(entry_colors == c) for c in range(n_colors)]
+
+        # jacobian preallocated in CSC format, with the position of each entry in its data array
+        entry_ids = csc_matrix((np.arange(1, len(self.rows)+1, dtype=float), (self.rows, self.cols)), shape=self.shape)
+        positions = np.empty(len(self.rows), dtype=np.int64)
+        positions[entry_ids.data.astype(np.int64) - 1] = np.arange(len(self.rows))
+        self._jac = csc_matrix((np.zeros(len(self.rows)), entry_ids.indices, entry_ids.indptr), shape=self.shape)
+        self._positions = [positions[entries] for entries in self._entries]
+        # buffers of the perturbed point and residuals
+        self._x = np.empty(int(self.sizes.sum()))
+        self._f = np.empty(self.shape[0])
+
+    @classmethod
+    def from_model(cls, model, x0):
+        """
+        Analyse the structure of a model around the point x0.
+        """
+        bnds = model.get_bounds()
+        sizes = [len(variable.value) for variable in model.root.variables]
+        free = np.flatnonzero(~_fixed_mask(bnds))
+        rows, cols, n_resid = _detect_sparsity(model.get_residuals, x0, free)
+        colors = _color_columns(rows, cols, (n_resid, len(free)))
+        return cls(sizes, free, rows, cols, colors, (n_resid, len(free)))
+
+    @classmethod
+    def from_function(cls, fun, x0):
+        """
+        Analyse the sparsity of the jacobian of a vector function fun with respect to all the entries of x, around the
+        point x0.
+        """
+        x0 = np.asarray(x0, dtype=float)
+        free = np.arange(len(x0))
+        rows, cols, n_resid = _detect_sparsity(fun, x0, free)
+        colors = _color_columns(rows, cols, (n_resid, len(free)))
+        return cls([len(x0)], free, rows, cols, colors, (n_resid, len(free)))
+
+    def jacobian(self, fun, x, f0):
+        """
+        Forward-difference approximation of the jacobian of fun with respect to the free variables, with one
+        evaluation of fun per color. The colors are evaluated one after the other (they perturb the same model), while
+        each evaluation of the residuals of a model may run on its thread pool (see
+        :meth:`cacao.components.generics.Composite.set_threads`).
+
+        :param fun: The function, called as fun(x, out=buffer) so that it writes its value in a buffer of the compiled
+            model, e.g :meth:`cacao.components.generics.Composite.get_residuals`.
+        :type fun: Callable
+        :param x: Point where the jacobian is computed.
+        :type x: numpy.ndarray
+        :param f0: Value of fun at x.
+        :type f0: numpy.ndarray
+
+        :return: The jacobian. The matrix is preallocated and overwritten by the next call.
+        :rtype: scipy.sparse.csc_matrix
+        """
+        x = np.asarray(x, dtype=float)
+        steps = _fd_step(x[self.free])
+        data = self._jac.data
+        x_pert = self._x
+        for group, entries, positions in zip(self._groups, self._entries, self._positions):
+            np.copyto(x_pert, x)
+            x_pert[self.free[group]] += steps[group]
+            df = fun(x_pert, out=self._f)
+            df -= f0
+            data[positions] = df[self.rows[entries]] / steps[self.cols[entries]]
+        # leave the model at the unperturbed point
+        fun(x, out=self._f)
+        return self._jac
+
+    def save(self, path):
+        np.savez(path, sizes=self.sizes, free=self.free, rows=self.rows, cols=self.cols, colors=self.colors,
+                 shape=np.array(self.shape))
+
+    def matches(self, model, x0):
+        """
+        Check that this compiled model fits a model: same size of the variables, same free variables, same number of
+        equations at x0 and a sparsity pattern which includes the dependencies of the equations. The dependencies are
+        probed by setting the variables of each color to NaN, i.e with one evaluation of the residuals per color.
+        """
+        sizes = [len(variable.value) for variable in model.root.variables]
+        free = np.flatnonzero(~_fixed_mask(model.get_bounds()))
+        x0 = np.array(x0, dtype=float)
+        n_resid = len(model.get_residuals(x0))
+        if not (np.array_equal(self.sizes, sizes) and np.array_equal(self.free, free)
+                and self.shape == (n_resid, len(free))):
+            return False
+
+        matches = True
+        with np.errstate(invalid='ignore'):
+            for group, entries in zip(self._groups, self._entries):
+                x_pert = x0.copy()
+                x_pert[self.free[group]] = np.nan
+                expected = np.zeros(n_resid, dtype=bool)
+                expected[self.rows[entries]] = True
+                if np.any(np.isnan(model.get_residuals(x_pert)) & ~expected):
+                    matches = False
+                    break
+        # leave the model at x0
+        model.get_residuals(x0)
+        return matches
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['sizes'], data['free'], data['rows'], data['cols'], data['colors'], data['shape'])
+
+def _detect_sparsity(fun, x0, free):
+    # a residual depends on a variable if it becomes NaN when the variable is NaN. Nonzeros of a finite difference
+    # jacobian are added for functions which do not propagate NaNs.
+    x0 = np.array(x0, dtype=float)
+    f0 = fun(x0)
+    steps = _fd_step(x0[free])
+    rows, cols = [], []
+    with np.errstate(invalid='ignore'):
+        for j, (col, step) in enumerate(zip(free, steps)):
+            x_pert = x0.copy()
+            x_pert[col] = np.nan
+            depends = np.isnan(fun(x_pert))
+            x_pert[col] = x0[col] + step
+            depends |= fun(x_pert) != f0
+            idx = np.flatnonzero(depends)
+            rows.append(idx)
+            cols.append(np.full(len(idx), j))
+    fun(x0)
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=np.int64)
+    return rows, cols, len(f0)
+
+def _color_columns(rows, cols, shape):
+    # greedy coloring of the column intersection graph
+    pattern_csc = csc_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+    pattern_csr = csr_matrix(pattern_csc)
+    colors = np.full(shape[1], -1, dtype=np.int64)
+    for j in range(shape[1]):
+        col_rows = pattern_csc.indices[pattern_csc.indptr[j]:pattern_csc.indptr[j+1]]
+        neighbors = np.concatenate([pattern_csr.indices[pattern_csr.indptr[i]:pattern_csr.indptr[i+1]]
+                                    for i in col_rows]) if len(col_rows) else np.array([], dtype=np.int64)
+        used = set(colors[neighbors][colors[neighbors] >= 0].tolist())
+        color = 0
+        while color in used:
+            color += 1
+        colors[j] = color
+    return colors
+
+def compile_model(model, x0=None, cache_dir=None):
+    """
+    Analyse the structure of a model. If a cache directory is given, the structure is loaded from a file named after
+    the fingerprint of the model when it exists and fits the model (see :meth:`CompiledModel.matches`), otherwise it is
+    computed and saved there for the next runs.
+
+    :param model: The cacao model
+    :type model: cacao.components.generics.Composite
+    :param x0: Point around which the structure is analysed. Defaults to the initial guess of the model.
+    :type x0: Iterable, optional
+    :param cache_dir: Directory where the compiled models are cached.
+    :type cache_dir: str, optional
+
+    :rtype: cacao.compiled.CompiledModel
+    """
+    if x0 is None:
+        x0 = model.get_initial_guess()
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f'{fingerprint(model)}.npz')
+        if os.path.exists(path):
+            compiled = CompiledModel.load(path)
+            # never trust a file which does not fit the model, recompute and overwrite it
+            if compiled.matches(model, x0):
+                return compiled
+
+    compiled = CompiledModel.from_model(model, x0)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that concurrent jobs never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        compiled.save(tmp_path)
+        os.replace(tmp_path, path)
+    return compiled
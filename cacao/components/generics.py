@@ -1,3 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from scipy.optimize import Bounds
+
+import numpy as np
+
 class Constant:
     """
     A simple class to represent constants in an optimization problem.
@@ -5,12 +11,24 @@ class Constant:
     :param value: The value of the constant. May be a scalar or a vector
     :type client: list, array, float or int.
     """
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
     def __call__(self):
         return self.value
 
+class Parameter(Constant):
+    """
+    A constant of the model whose influence on the solution can be analysed, e.g with
+    :meth:`cacao.problems.SimulationProblem.sensitivities`.
+
+    :param value: The value of the parameter. May be a scalar or a vector
+    :type client: list, array, float or int.
+    """
+    __slots__ = ()
+
 class Variable:
     """
     This class representa a decision variable in an optimization problem.
@@ -22,18 +40,17 @@ class Variable:
     only positive, so the bounds would be (0.0, None).
     :type bounds: tuple
     """
-    def __init__(self, index_var=[0], bounds=(None, None)):
-        self.value = [100] * len(index_var)
-        # create array of Nones with 2 None for each variable
-        #bnds = np.array([None for i in range(len(index_var)* 2)])
-        bnds = [bounds for i in range(len(index_var))]
+    __slots__ = ('value', 'lb', 'ub')
 
-        # reshape to have 2 Nones on last dimension
-        #bnds = bnds.reshape(len(index_var), 2)
-        self.bounds = bnds
+    def __init__(self, index_var=[0], bounds=(None, None)):
+        size = len(index_var)
+        self.value = np.full(size, 100.0)
+        # lower and upper bounds are stored as arrays, None meaning no bound
+        self.lb = np.full(size, -np.inf if bounds[0] is None else bounds[0], dtype=float)
+        self.ub = np.full(size, np.inf if bounds[1] is None else bounds[1], dtype=float)
 
     def get_bounds(self):
-        return self.bounds
+        return Bounds(self.lb, self.ub)
     
     def  __setitem__(self, key, item):
         '''
@@ -42,16 +59,18 @@ class Variable:
         '''
         # specify a single value or (min, max) for as a constraint for an
         # indexed var
-        if isinstance(item, float) or isinstance(item, int):
-            self.bounds[key] = (item, item)
+        if isinstance(item, (float, int, np.number)):
+            self.lb[key] = item
+            self.ub[key] = item
         elif isinstance(item, tuple):
-            self.bounds[key] = item
+            self.lb[key] = -np.inf if item[0] is None else item[0]
+            self.ub[key] = np.inf if item[1] is None else item[1]
         else:
             raise ValueError('Only tuple or numeric values are allowed as bounds.')
 
 
     def set_value(self, x):
-        self.value = x
+        self.value[...] = x
 
     def __call__(self):
         return self.value
@@ -77,14 +96,30 @@ class Constraint:
     :param ub: The upper bound of constraint. Normally for an equality constraint lower and upper bound are set to zero.
     :type ub: float or int, optional.
     """
+    __slots__ = ('rule', 'lb', 'ub')
+
     def __init__(self, rule, lb=0, ub=0):
         self.rule = rule
-        self.ub = lb
-        self.lb = ub
+        self.lb = lb
+        self.ub = ub
     
     def __call__(self, model):
         return self.rule(model)
 
+class _ConstraintFunction:
+    """
+    Residual function of a constraint of a block, as a function of the values of all the variables of the model.
+    """
+    __slots__ = ('block', 'constraint')
+
+    def __init__(self, block, constraint):
+        self.block = block
+        self.constraint = constraint
+
+    def __call__(self, x):
+        self.block.change_inputs(x)
+        return self.constraint(self.block)
+
 class Block:
     """
     This class represents a conceptual block, a unit which has some meaning to hold certain variables and constraints within
@@ -92,96 +127,280 @@ class Block:
     """
     def __init__(self):
         self.variables = []
+        self.parameters = []
         self.constraints = []
         self.parent = None
+        self.root = None
         self.time = None
 
     def set_parent(self, parent):
         self.parent = parent
+        self.set_root(parent.root)
+
+    def set_root(self, root):
+        self.root = root
     
     def __setattr__(self, name, value):
         if isinstance(value, Variable):
             super().__setattr__(name, value)
             self.variables.append(value)
+            self._changed()
+        elif isinstance(value, Parameter):
+            super().__setattr__(name, value)
+            self.parameters.append(value)
+            self._changed()
         elif isinstance(value, Constraint):
             self.add_cons( value, value.lb, value.ub)
+            self._changed()
         else:
             super().__setattr__(name, value)
 
+    def _changed(self):
+        # notify the composites above that the structure of the model changed
+        parent = getattr(self, 'parent', None)
+        if parent is not None:
+            parent._changed()
+
     def update_time(self, time_vec):
         self.time = time_vec
 
     def change_inputs(self, x):
-        self.parent.change_inputs(x)
+        self.root.change_inputs(x)
 
     def add_cons(self, constraint, lb=0, ub=0):
-
-        def cons(x):
-            self.change_inputs(x)
-            return constraint(self)
-
-        self.constraints.append( {'type': 'eq', 'fun': cons} )
+        cons = _ConstraintFunction(self, constraint)
+        self.constraints.append( {'type': 'eq', 'fun': cons, 'rule': constraint.rule, 'block': self} )
 
 
 class Composite:
     """
     This class represents a higher-level block, able to "aggregate" multiple blocks. In Composite design pattern, the
-    composite is a high-level block while the Block class is a leaf. 
+    composite is a high-level block while the Block class is a leaf. Composites may be nested, e.g a sub-catchment
+    composite reused many times inside a basin model.
+
+    The values of all the variables of the model are stored in a single flat vector owned by the root composite, each
+    variable being a view on its slice of this vector. Called on a nested composite, :meth:`change_inputs`,
+    :meth:`get_initial_guess`, :meth:`get_bounds`, :meth:`get_constraints` and :meth:`get_residuals` refer to the whole
+    model (the root composite), so that a problem created for a nested composite is consistent. The attributes
+    variables, parameters and constraints list those of the composite itself.
     """
     def __init__(self):
-        self.variables = []
-        self.constraints = []
         self.blocks = []
         self.time = [0]
-        self.parent=None
+        self.parent = None
+        self.root = self
+        self._flat = None # variables, parameters and constraints of the subtree
+        self._x = None # root only: values of all variables
+        self._index = None # root only: slice of each variable in self._x
+        self._rows = None # rows of each constraint in the residual vector
+        self._groups = None # groups of constraints evaluated concurrently
+        self._n_threads = 1
+        self._executor = None
+        self._owns_executor = False # the executor was created by set_threads, and is shut down by it
 
     def __setattr__(self, name, value):
-        if isinstance(value, Block):
+        if name not in ('parent', 'root') and isinstance(value, (Block, Composite)):
             block = value
-            for variable in block.variables:
-                self.variables.append(variable)
-            for constraint in block.constraints:
-                self.constraints.append(constraint)
             block.set_parent(self)
             block.update_time( self.time )
             self.blocks.append( block )
+            self._changed()
         super().__setattr__(name, value)
 
+    def set_parent(self, parent):
+        self.parent = parent
+        self.set_root(parent.root)
+
+    def set_root(self, root):
+        self.root = root
+        self._x = None
+        self._index = None
+        for block in self.blocks:
+            block.set_root(root)
+
+    def __getstate__(self):
+        # the flat vector of values is rebuilt from the variables, and thread pools are not shared with copies
+        state = self.__dict__.copy()
+        state.update(_x=None, _index=None, _groups=None, _executor=None, _owns_executor=False, _n_threads=1)
+        return state
+
+    def _changed(self):
+        # drop the flattened structure of this composite and its ancestors, the root rebuilds its state on next access
+        self._flat = None
+        self._rows = None
+        self._groups = None
+        if self.root is self:
+            self._x = None
+            self._index = None
+        elif self.parent is not None:
+            self.parent._changed()
+
+    def _flatten(self):
+        if self._flat is None:
+            variables, parameters, constraints = [], [], []
+            for block in self.blocks:
+                variables.extend(block.variables)
+                parameters.extend(block.parameters)
+                constraints.extend(block.constraints)
+            self._flat = (variables, parameters, constraints)
+        return self._flat
+
+    @property
+    def variables(self):
+        return self._flatten()[0]
+
+    @property
+    def parameters(self):
+        return self._flatten()[1]
+
+    @property
+    def constraints(self):
+        return self._flatten()[2]
+
+    def _state(self):
+        # flat vector with the values of all variables, built once by the root and shared through views
+        root = self.root
+        if root._x is None:
+            variables = root.variables
+            x = np.concatenate([np.asarray(variable.value, dtype=float) for variable in variables]) if variables else np.zeros(0)
+            index = {}
+            curr_index = 0
+            for variable in variables:
+                size = len(variable.value)
+                index[id(variable)] = slice(curr_index, curr_index+size)
+                variable.value = x[curr_index:curr_index+size]
+                curr_index += size
+            root._x = x
+            root._index = index
+        return root._x
+
+    def get_index(self, variable):
+        """
+        Position of a variable in the flat vector of values of the model (e.g the x of a simulation result).
+
+        :param variable: A variable of the model
+        :type variable: cacao.components.generics.Variable
+
+        :rtype: slice
+        """
+        self._state()
+        return self.root._index[id(variable)]
+
+    def get_blocks(self):
+        """
+        :return: All the (leaf) blocks of the model, including those of nested composites, in the order of their
+            variables.
+        :rtype: list
+        """
+        blocks = []
+        for block in self.blocks:
+            if isinstance(block, Composite):
+                blocks.extend(block.get_blocks())
+            else:
+                blocks.append(block)
+        return blocks
+
     def update_time(self, time_vec):
         self.time = time_vec
         for block in self.blocks:
             block.update_time( time_vec )
 
     def change_inputs(self, x):
-        # if this is not a root block, then call recursively the parent until it reaches the root node
-        if self.parent:
-            self.parent.change_inputs(x)
-        else: # this is the root node
-            curr_index = 0
-            for variable in self.variables:
-                variable.set_value(x[curr_index:curr_index+len(variable.value)])
-                curr_index += len(variable.value)
+        np.copyto(self._state(), x)
     
     def get_initial_guess(self):
-        if self.parent:
-            self.parent.get_initial_guess()
-        else: # this is the root node
-            xGuess = []
-            for variable in self.variables:
-                xGuess.extend(variable.value)
-
-        return xGuess
+        return self._state().copy()
 
     def get_bounds(self):
-        # collect the bounds for all variables
-        bnds = []
-        for variable in self.variables:
-            bnds.extend( variable.get_bounds() ) 
+        # collect the bounds for all variables of the model
+        variables = self.root.variables
+        lb = np.concatenate([variable.lb for variable in variables] or [np.zeros(0)])
+        ub = np.concatenate([variable.ub for variable in variables] or [np.zeros(0)])
 
-        return bnds
+        return Bounds(lb, ub)
     
     def get_constraints(self):
-        return self.constraints
+        return self.root.constraints
+
+    def set_threads(self, n_threads, executor=None):
+        """
+        Evaluate the constraints of the model concurrently. The blocks are partitioned in n_threads groups with a similar
+        number of equations, which are evaluated on a thread pool, each group writing into its own slice of the residual
+        vector. This pays off for large models whose constraints perform numpy operations on long vectors (which release
+        the GIL). The constraint rules must not modify the model.
+
+        :param n_threads: Number of groups of blocks evaluated concurrently. Use 1 to evaluate them sequentially.
+        :type n_threads: int
+        :param executor: Thread pool running the evaluations, e.g shared by several models. Defaults to a new
+            concurrent.futures.ThreadPoolExecutor with n_threads workers, which is shut down by the next call to
+            set_threads.
+        :type executor: concurrent.futures.ThreadPoolExecutor, optional
+        """
+        if self.root is not self:
+            return self.root.set_threads(n_threads, executor)
+        if self._owns_executor:
+            self._executor.shutdown()
+        self._owns_executor = n_threads > 1 and executor is None
+        if self._owns_executor:
+            executor = ThreadPoolExecutor(n_threads)
+        self._n_threads = n_threads
+        self._executor = executor if n_threads > 1 else None
+        self._groups = None
+
+    def _layout_residuals(self):
+        # position of each constraint in the residual vector, found by evaluating the constraints once
+        if self._rows is None:
+            sizes = [np.size(constraint['rule'](constraint['block'])) for constraint in self.constraints]
+            offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+            self._rows = [slice(offsets[i], offsets[i+1]) for i in range(len(sizes))]
+        if self._groups is None:
+            # contiguous groups of whole blocks, with a similar number of rows
+            constraints = self.constraints
+            n_resid = self._rows[-1].stop if self._rows else 0
+            n_groups = max(1, min(self._n_threads, len(constraints)))
+            groups, group, group_rows = [], [], 0
+            for i, constraint in enumerate(constraints):
+                new_block = i > 0 and constraint['block'] is not constraints[i-1]['block']
+                if new_block and group_rows >= n_resid / n_groups and len(groups) < n_groups - 1:
+                    groups.append(group)
+                    group, group_rows = [], 0
+                group.append(i)
+                group_rows += self._rows[i].stop - self._rows[i].start
+            groups.append(group)
+            self._groups = groups
+        return self._rows
+
+    def _evaluate_group(self, group, out):
+        constraints = self.constraints
+        for i in group:
+            constraint = constraints[i]
+            out[self._rows[i]] = constraint['rule'](constraint['block'])
+
+    def get_residuals(self, x, out=None):
+        """
+        Evaluate all the constraints of the model at the point x and stack them in a single residual vector.
+
+        :param x: Values of all the variables of the model.
+        :type x: Iterable
+        :param out: Array where the residuals are written. Defaults to a new array.
+        :type out: numpy.ndarray, optional
+
+        :return: Residuals of the constraints, in the order they were added to the model.
+        :rtype: numpy.ndarray
+        """
+        if self.root is not self:
+            return self.root.get_residuals(x, out)
+        self.change_inputs(x)
+        rows = self._layout_residuals()
+        if out is None:
+            out = np.empty(rows[-1].stop if rows else 0)
+        if self._executor is None:
+            self._evaluate_group(range(len(self.constraints)), out)
+        else:
+            futures = [self._executor.submit(self._evaluate_group, group, out) for group in self._groups]
+            for future in futures:
+                future.result()
+        return out
 
     def connect(self, block1, block2):
         #inport.set_variable(outport.get_variable())
@@ -1,10 +1,34 @@
-from .generics import Block, Constant, Variable, Constraint
+from .generics import Block, Parameter, Variable, Constraint
 
 from scipy import interpolate
 import numpy as np
 
 g = 9.81 # m/s2 gravity
 
+# constraint rules are module-level functions, so that models can be pickled (e.g to run in a process pool)
+
+def _mass_balance(block):
+    dmdt = np.diff(block.mass())/np.diff(block.time)
+    inflow = np.zeros_like(block.time)
+    for block2 in block.inlet:
+        inflow += block2.mass_flow_rate()
+    outflow = np.zeros_like(block.time)
+    for block2 in block.outlet:
+        outflow += block2.mass_flow_rate()
+    resid = dmdt - (inflow[1:] - outflow[1:])
+    return resid
+
+def _volume_height(block):
+    resid = block.mass() - block.area * block.content.material.rho * block.height()
+    return resid
+
+def _outflow(block):
+    h = np.maximum(0.0, block.inlet[0].height())
+    content = block.inlet[0].content
+    resid = block.mass_flow_rate() - content.material.rho*block.area*block.opening()*block.c()*(2*g*h)**0.5
+
+    return resid
+
 class Tank(Block):
     """
     Create a container (vessel, reservoir, etc) unit that has liquid holdup and one or more inlets and outlets.
@@ -29,24 +53,8 @@ class Tank(Block):
 
         self.mass[0] = content.initial_mass # initial condition
 
-        def mass_balance(block):
-            dmdt = np.diff(block.mass())/np.diff(block.time)
-            inflow = np.zeros_like(block.time)
-            for block2 in block.inlet:
-                inflow += block2.mass_flow_rate()
-            outflow = np.zeros_like(block.time)
-            for block2 in block.outlet:
-                outflow += block2.mass_flow_rate()
-            resid = dmdt - (inflow[1:] - outflow[1:])
-            return resid
-
-        self.mass_balance = Constraint(mass_balance)
-
-        def volume_height(block):
-            resid = block.mass() - block.area * content.material.rho * block.height()
-            return resid
-
-        self.volume_height = Constraint(volume_height)
+        self.mass_balance = Constraint(_mass_balance)
+        self.volume_height = Constraint(_volume_height)
 
 class Orifice(Block):
     """
@@ -59,23 +67,20 @@ class Orifice(Block):
     :type bounds: float
     :param c: Outflow coefficient due to orifice properties, normally obtained empirically.
     :type bounds: float
+    :param opening: Fraction of the orifice area which is open (0 = closed, 1 = fully open), at each time step. Defaults to 1.0.
+    :type opening: float, optional
 
     """
-    def __init__(self, time_vec, area, c):
+    def __init__(self, time_vec, area, c, opening=1.0):
         super().__init__()
         self.mass_flow_rate = Variable(time_vec)
         self.area = area
+        self.c = Parameter(c)
+        self.opening = Parameter(np.full(len(time_vec), opening, dtype=float))
         self.inlet = []
         self.outlet = []
 
-        def outflow(block):
-            h = np.maximum(0.0, block.inlet[0].height())
-            content = block.inlet[0].content
-            resid = block.mass_flow_rate() - content.material.rho*block.area*c*(2*g*h)**0.5
-
-            return resid
-
-        self.mech_energy = Constraint(outflow)
+        self.mech_energy = Constraint(_outflow)
 
 class Stream(Block):
     """
@@ -102,7 +107,6 @@ class Stream(Block):
             flow_rate = func(time_vec)
 
 
-        self.mass_flow_rate = Constant(flow_rate)
-        self.outport_flow = OutPort(self.mass_flow_rate)
+        self.mass_flow_rate = Parameter(np.asarray(flow_rate, dtype=float))
         self.inlet = []
         self.outlet = []
\ No newline at end of file
@@ -1,32 +1,493 @@
-from scipy.optimize import minimize
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import functools
+import threading
+import time
+
+from scipy.optimize import minimize, Bounds, NonlinearConstraint, OptimizeResult
+from scipy.sparse.linalg import splu
 
 import numpy as np
 
+from cacao.compiled import CompiledModel, compile_model, fingerprint, _fd_step
+
+def _approx_jacobian(fun, x, cols, f0=None):
+    """
+    Forward-difference approximation of the jacobian of fun with respect to the entries cols of x.
+    """
+    x = np.array(x, dtype=float)
+    if f0 is None:
+        f0 = fun(x)
+    steps = _fd_step(x[cols])
+    jac = np.empty((len(f0), len(cols)))
+    for j, (col, step) in enumerate(zip(cols, steps)):
+        x_pert = x.copy()
+        x_pert[col] += step
+        jac[:, j] = (fun(x_pert) - f0) / step
+    # leave the model at the unperturbed point
+    fun(x)
+    return jac
+
+def _get_values(constants):
+    # stack the values of a list of constants/parameters in a single vector
+    return np.concatenate([np.atleast_1d(np.asarray(constant(), dtype=float)) for constant in constants])
+
+def _set_values(constants, values):
+    curr_index = 0
+    for constant in constants:
+        size = np.size(constant())
+        if np.ndim(constant()) == 0:
+            constant.value = float(values[curr_index])
+        else:
+            constant.value = np.array(values[curr_index:curr_index+size], dtype=float)
+        curr_index += size
+
+class _Budget:
+    """
+    Wall-clock and cancellation budget of a solver, checked at each iteration.
+    """
+    def __init__(self, timeout=None, cancel=None):
+        self.start = time.monotonic()
+        self.deadline = None if timeout is None else self.start + timeout
+        self.cancel = cancel
+        self.reason = None
+
+    def exceeded(self):
+        if self.cancel is not None and self.cancel.is_set():
+            self.reason = 'cancelled'
+        elif self.deadline is not None and time.monotonic() > self.deadline:
+            self.reason = 'timeout'
+        return self.reason is not None
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
 class SimulationProblem:
     """
     Create a simulation problem, i.e a problem with no degrees of freedom (number of variables = number of constraints)
 
     :param model: The cacao model to be simulated
     :type model: cacao.generics.Composite
+    :param cache_dir: Directory where the structure of the model (see :func:`cacao.compiled.compile_model`) is cached
+        between runs. Defaults to None (no cache).
+    :type cache_dir: str, optional
     """
-    def __init__(self, model):
+    def __init__(self, model, cache_dir=None):
         self.model = model
-    
-    def run(self, verbose = False):
+        self.cache_dir = cache_dir
+        self.compiled = None
+        self._compiled_key = None # fingerprint of the model when it was compiled
+        self.x = None
+        self._lu = None
+        self._lu_x = None # solution at which self._lu was computed
+
+    def run(self, verbose = False, method='trust-constr', x0=None, tol=1e-8, maxiter=None, timeout=None, cancel=None):
         """
         Perform a simulation of the cacao model along the time steps defined in the model (model.time)
 
         :param verbose: Set to True to see extended output. Defaults to False.
         :type verbose: bool, optional
+        :param method: Solver to use. 'trust-constr' solves the model as a constrained minimization with scipy, 'newton'
+            solves the equations directly with a damped Newton method (faster, but only fixed-value bounds and simple
+            clipping are honored). Defaults to 'trust-constr'.
+        :type method: str, optional
+        :param x0: Initial guess for the variables. Defaults to the current value of the model variables.
+        :type x0: Iterable, optional
+        :param tol: Tolerance on the maximum absolute residual (only used by 'newton'). Defaults to 1e-8.
+        :type tol: float, optional
+        :param maxiter: Maximum number of iterations. Defaults to 50 for 'newton' and to the scipy default for
+            'trust-constr'.
+        :type maxiter: int, optional
+        :param timeout: Wall-clock budget (s). When it is exceeded the solver stops at the end of the current iteration.
+        :type timeout: float, optional
+        :param cancel: An event (e.g threading.Event) checked at each iteration. When it is set the solver stops.
+        :type cancel: threading.Event, optional
 
-        :return: Simulation results (attribute x contains the actual solution value of the variables).
+        :return: Simulation results (attribute x contains the actual solution value of the variables). When the solver is
+            stopped by the timeout or the cancel event, x contains the last iterate, success is False and the attributes
+            timed_out or cancelled are True. The attributes execution_time and max_residual are always set.
         :rtype: scipy.optimize.OptimizeResult
         """
-        obj = lambda x: 0.0
-        xGuess = self.model.get_initial_guess()
+        budget = _Budget(timeout, cancel)
+        xGuess = self.model.get_initial_guess() if x0 is None else x0
         bnds = self.model.get_bounds()
-        cons = self.model.get_constraints()
-        res = minimize(obj, xGuess, method='trust-constr',bounds=bnds, constraints=cons)
+        if method == 'trust-constr':
+            obj = lambda x: 0.0
+            # all the equations as a single vector constraint, evaluated by the model (possibly on its thread pool). scipy
+            # keeps the returned residuals, so each evaluation returns a new array.
+            cons = NonlinearConstraint(self.model.get_residuals, 0.0, 0.0)
+            options = {} if maxiter is None else {'maxiter': maxiter}
+            res = minimize(obj, xGuess, method='trust-constr',bounds=bnds, constraints=cons, options=options,
+                           callback=lambda xk, state: budget.exceeded())
+            self._lu = None
+        elif method == 'newton':
+            res = self._newton(xGuess, bnds, tol, 50 if maxiter is None else maxiter, budget)
+            # the last factorization of the Newton loop is computed at the returned point
+            self._lu_x = res.x
+        else:
+            raise ValueError(f'Unknown simulation method: {method}')
+
+        res.cancelled = budget.reason == 'cancelled'
+        res.timed_out = budget.reason == 'timeout'
+        if budget.reason is not None:
+            res.success = False
+            res.message = 'Simulation cancelled.' if res.cancelled else 'Time limit reached.'
+        res.execution_time = budget.elapsed()
+        # the Newton result already holds the residuals at the solution
+        resid = res.fun if method == 'newton' else self.model.get_residuals(res.x)
+        res.max_residual = float(np.max(np.abs(resid), initial=0.0))
+
+        self.x = res.x
+        self.model.change_inputs(res.x)
+        if verbose:
+            print(res)
+        return res
+
+    async def run_async(self, executor=None, timeout=None, cancel=None, **kwargs):
+        """
+        Coroutine version of :meth:`run`, which runs the simulation in an executor so that the event loop is not
+        blocked. If the coroutine is cancelled (e.g by asyncio.wait_for) the solver is asked to stop at the end of its
+        current iteration.
+
+        Each concurrent simulation must use its own model and problem. With a ProcessPoolExecutor, the problem is pickled
+        to the worker process: the constraint rules of user-defined blocks must then be module-level functions (not
+        lambdas or local functions), the model is evaluated sequentially in the worker, and cooperative cancellation
+        requires a cancel event shared between processes (e.g multiprocessing.Manager().Event()). The timeout is always
+        honored.
+
+        :param executor: The executor running the simulation. Defaults to the default executor of the event loop.
+        :type executor: concurrent.futures.Executor, optional
+        :param timeout: Wall-clock budget (s), see :meth:`run`.
+        :type timeout: float, optional
+        :param cancel: Event used to stop the solver. Defaults to a new threading.Event for thread executors.
+        :type cancel: threading.Event, optional
+        :param kwargs: Other arguments of :meth:`run`.
+
+        :return: Simulation results, see :meth:`run`.
+        :rtype: scipy.optimize.OptimizeResult
+        """
+        in_process = isinstance(executor, ProcessPoolExecutor)
+        if cancel is None and not in_process:
+            cancel = threading.Event()
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.run, timeout=timeout, cancel=cancel, **kwargs)
+        try:
+            res = await loop.run_in_executor(executor, call)
+        except asyncio.CancelledError:
+            if cancel is not None:
+                cancel.set()
+            raise
+        if in_process:
+            # the simulation ran on a copy of the problem
+            self.x = res.x
+            self._lu = None
+            self.model.change_inputs(res.x)
+        return res
+
+    def __getstate__(self):
+        # the factorization cannot be pickled, it is computed again on demand
+        state = self.__dict__.copy()
+        state.update(_lu=None, _lu_x=None)
+        return state
+
+    def compile(self, x0=None):
+        """
+        Analyse (or load from the cache) the structure of the model: variable layout, sparsity and coloring of the
+        constraints jacobian. This is done automatically by the solvers, and done again whenever the structure of the
+        model (e.g blocks, or variables fixed by the bounds) changes.
+
+        :rtype: cacao.compiled.CompiledModel
+        """
+        key = fingerprint(self.model)
+        if self.compiled is None or key != self._compiled_key:
+            self.compiled = compile_model(self.model, x0, self.cache_dir)
+            self._compiled_key = key
+            self._lu = None
+        return self.compiled
+
+    def _jacobian(self, x, resid=None):
+        # jacobian of the constraints with respect to the free (i.e. not fixed by the bounds) variables
+        if resid is None:
+            resid = self.model.get_residuals(x)
+        return self.compiled.jacobian(self.model.get_residuals, x, resid)
+
+    def _factorize(self, x):
+        self.compile(x)
+        jac = self._jacobian(x)
+        self._lu = None
+        if jac.shape[0] == jac.shape[1]:
+            try:
+                self._lu = splu(jac)
+            except RuntimeError:
+                # singular jacobian, no factorization available at this point
+                pass
+        return self._lu
+
+    def _factorization(self):
+        # factorization of the constraints jacobian at the current solution, computed on first use
+        if self._lu is None or self._lu_x is not self.x:
+            self._factorize(self.x)
+            self._lu_x = self.x
+        return self._lu
+
+    def _newton(self, x0, bnds, tol, maxiter, budget):
+        lb, ub = bnds.lb, bnds.ub
+        x = np.clip(np.array(x0, dtype=float), lb, ub)
+        x[lb == ub] = lb[lb == ub]
+        free = self.compile(x).free
+
+        # residuals at the current and trial points, and trial point, written in place at each iteration
+        resid = self.model.get_residuals(x)
+        if len(resid) != len(free):
+            raise ValueError(f'The model has {len(free)} free variables but {len(resid)} equations. '
+                             'Newton method requires a model with no degrees of freedom.')
+        resid_new = np.empty_like(resid)
+        x_new = np.empty_like(x)
+        nit = 0
+        success = False
+        message = 'Maximum number of iterations has been exceeded.'
+        while True:
+            if budget.exceeded():
+                self._lu = None
+                break
+            jac = self._jacobian(x, resid)
+            try:
+                self._lu = splu(jac)
+            except RuntimeError:
+                self._lu = None
+                message = 'Singular jacobian.'
+                break
+            if np.max(np.abs(resid)) <= tol:
+                success = True
+                message = 'Residual tolerance reached.'
+                break
+            if nit >= maxiter:
+                break
+            nit += 1
+            dx = self._lu.solve(resid)
+            # backtracking on the norm of the residuals
+            norm = np.linalg.norm(resid)
+            alpha = 1.0
+            while True:
+                np.copyto(x_new, x)
+                x_new[free] = np.clip(x[free] - alpha*dx, lb[free], ub[free])
+                self.model.get_residuals(x_new, out=resid_new)
+                if np.linalg.norm(resid_new) < norm or alpha < 1e-4:
+                    break
+                alpha *= 0.5
+            x, x_new = x_new, x
+            resid, resid_new = resid_new, resid
+
+        return OptimizeResult(x=x, fun=resid, success=success, status=int(success), message=message, nit=nit)
+
+    def _residuals_jacobian_params(self, params, structure=None):
+        # jacobian of the constraints with respect to the entries of the parameters, at the current solution. With the
+        # sparsity structure of this jacobian, parameter entries touching disjoint rows are perturbed together.
+        p0 = _get_values(params)
+
+        def fun(p, out=None):
+            _set_values(params, p)
+            return self.model.get_residuals(self.x, out)
+
+        if structure is None:
+            return _approx_jacobian(fun, p0, np.arange(len(p0)))
+        return structure.jacobian(fun, p0, fun(p0))
+
+    def sensitivities(self, params):
+        """
+        Compute the sensitivities of the solution with respect to parameters of the model (dx/dp), after the model has
+        been simulated with :meth:`run`.
+
+        The sensitivities are obtained from the implicit function theorem, reusing the factorization of the constraints
+        jacobian computed at the solution: k parameter entries cost k back-substitutions instead of k simulations.
+
+        :param params: The parameters, e.g [model.orifice.c, model.stream.mass_flow_rate]
+        :type params: list of cacao.components.generics.Parameter
+
+        :return: For each variable of the model, an array with shape (length of the variable, number of parameter
+            entries), where the columns follow the order of params (vector parameters contribute one column per entry).
+        :rtype: dict
+        """
+        if self.x is None:
+            raise RuntimeError('The model must be simulated before computing sensitivities.')
+        lu = self._factorization()
+        if lu is None:
+            raise RuntimeError('The constraints jacobian is singular or not square at the solution.')
+
+        free = self.compile(self.x).free
+        dcdp = self._residuals_jacobian_params(params)
+        dxdp = np.zeros((len(self.x), dcdp.shape[1]))
+        dxdp[free] = -lu.solve(dcdp)
+
+        return {variable: dxdp[self.model.get_index(variable)] for variable in self.model.variables}
+
+class OptimizationProblem:
+    """
+    Create a dynamic optimization problem, i.e find the value of some inputs of the model (the controls, such as Stream
+    flow rates or Orifice openings) which minimize an objective over the model variables.
+
+    The model is simulated for each trial value of the controls and the gradient of the objective is computed with the
+    adjoint method: a single linear system with the transpose of the constraints jacobian is solved per gradient,
+    whatever the number of controls. The partial derivatives of the constraints with respect to the controls are
+    approximated by finite differences, perturbing together the control entries which act on different equations (e.g
+    the entries of a Stream flow rate along time), so their cost is one residual evaluation per group rather than per
+    control entry. The partial derivatives of the objective cost one objective evaluation per variable or control entry
+    the objective actually depends on. These dependencies are detected at the first evaluation, at the expense of about
+    two residual evaluations per control entry and two objective evaluations per variable and control entry.
+
+    :param model: The cacao model to be optimized
+    :type model: cacao.generics.Composite
+    :param objective: A python function returning the (scalar) objective. The signature must be
+
+    .. highlight:: python
+    .. code-block:: python
+
+        def objective(model):
+            f = ....
+            return f
+        ...
+
+    :type objective: Callable
+    :param controls: The inputs of the model to be optimized, e.g [model.stream.mass_flow_rate, model.orifice.opening]
+    :type controls: list of cacao.components.generics.Constant
+    :param bounds: Bounds (lower, upper) for each control, applied to all its entries. Use None for no bound.
+    :type bounds: list of tuple, optional
+    :param sense: 'minimize' or 'maximize'. Defaults to 'minimize'.
+    :type sense: str, optional
+    :param cache_dir: Directory where the structure of the model is cached between runs (see
+        :class:`SimulationProblem`).
+    :type cache_dir: str, optional
+    """
+    def __init__(self, model, objective, controls, bounds=None, sense='minimize', cache_dir=None):
+        if sense not in ('minimize', 'maximize'):
+            raise ValueError("sense must be 'minimize' or 'maximize'.")
+        self.model = model
+        self.objective = objective
+        self.controls = controls
+        self.bounds = bounds if bounds is not None else [(None, None)] * len(controls)
+        self.sign = 1.0 if sense == 'minimize' else -1.0
+        self.simulation = SimulationProblem(model, cache_dir)
+        self._last = None
+        self._controls_structure = None # sparsity of the constraints with respect to the controls
+        self._objective_structure = None # variables and controls the objective depends on
+
+    def get_controls(self):
+        """
+        :return: Current values of all controls, stacked in a single vector.
+        :rtype: numpy.ndarray
+        """
+        return _get_values(self.controls)
+
+    def set_controls(self, u):
+        """
+        Change the value of the controls.
+
+        :param u: Values of all controls, stacked in a single vector.
+        :type u: Iterable
+        """
+        _set_values(self.controls, u)
+
+    def get_bounds(self):
+        """
+        :return: Bounds of all controls, stacked in a single vector.
+        :rtype: scipy.optimize.Bounds
+        """
+        sizes = [np.size(control()) for control in self.controls]
+        lb = np.repeat([-np.inf if bound[0] is None else bound[0] for bound in self.bounds], sizes)
+        ub = np.repeat([np.inf if bound[1] is None else bound[1] for bound in self.bounds], sizes)
+        return Bounds(lb, ub)
+
+    def _eval_objective(self, x, u):
+        self.set_controls(u)
+        self.model.change_inputs(x)
+        return float(self.objective(self.model))
+
+    def _eval_residuals(self, x, u):
+        self.set_controls(u)
+        return self.model.get_residuals(x)
+
+    def evaluate(self, u):
+        """
+        Simulate the model for the given controls and compute the objective and its gradient with respect to the
+        controls (adjoint method).
+
+        :param u: Values of all controls, stacked in a single vector.
+        :type u: Iterable
+
+        :return: Objective value and gradient, whatever the sense of the problem (:meth:`run` negates them to maximize).
+        :rtype: tuple(float, numpy.ndarray)
+        """
+        u = np.array(u, dtype=float)
+        if self._last is not None and np.array_equal(u, self._last[0]):
+            return self._last[1], self._last[2]
+
+        self.set_controls(u)
+        res = self.simulation.run(method='newton', x0=self.simulation.x)
+        lu = self.simulation._factorization() if res.success else None
+        if lu is None:
+            raise RuntimeError(f'Simulation failed for the given controls: {res.message}')
+        x = res.x
+        free = self.simulation.compiled.free
+        n_free = len(free)
+
+        # partial derivatives of the objective, as a function of the free variables and the controls
+        def objective(z, out=None):
+            x_ = x.copy()
+            x_[free] = z[:n_free]
+            if out is None:
+                out = np.empty(1)
+            out[0] = self._eval_objective(x_, z[n_free:])
+            return out
+
+        z = np.concatenate([x[free], u])
+        f0 = objective(z)
+        if self._objective_structure is None or self._objective_structure.shape[1] != len(z):
+            self._objective_structure = CompiledModel.from_function(objective, z)
+        dfdz = self._objective_structure.jacobian(objective, z, f0).toarray()[0]
+        dfdx, dfdu = dfdz[:n_free], dfdz[n_free:]
+
+        # partial derivatives of the constraints with respect to the controls
+        if self._controls_structure is None or self._controls_structure.shape != (n_free, len(u)):
+            self._controls_structure = CompiledModel.from_function(
+                lambda u_: self._eval_residuals(x, u_), u)
+        dcdu = self.simulation._residuals_jacobian_params(self.controls, self._controls_structure)
+
+        # adjoint equations: (dc/dx)^T lambda = (df/dx)^T
+        adjoint = lu.solve(dfdx, trans='T')
+        grad = dfdu - dcdu.T @ adjoint
+        f = f0[0]
+
+        self.set_controls(u)
+        self.model.change_inputs(x)
+        self._last = (u, f, grad)
+        return f, grad
+
+    def run(self, verbose=False, method='L-BFGS-B', options=None):
+        """
+        Solve the optimization problem, starting from the current value of the controls.
+
+        :param verbose: Set to True to see extended output. Defaults to False.
+        :type verbose: bool, optional
+        :param method: Gradient-based scipy.optimize.minimize method. Defaults to 'L-BFGS-B'.
+        :type method: str, optional
+        :param options: Options passed to the scipy solver.
+        :type options: dict, optional
+
+        :return: Optimization results (attribute x contains the optimal value of the controls).
+        :rtype: scipy.optimize.OptimizeResult
+        """
+        def fun(u):
+            f, grad = self.evaluate(u)
+            return self.sign * f, self.sign * grad
+
+        u0 = self.get_controls()
+        res = minimize(fun, u0, jac=True, method=method, bounds=self.get_bounds(), options=options)
+        res.fun = self.sign * res.fun
+        if 'jac' in res:
+            res.jac = self.sign * res.jac
+        # leave the model at the optimal solution
+        self.evaluate(res.x)
+        res.model_x = self.simulation.x
         if verbose:
             print(res)
-        return res
\ No newline at end of file
+        return res
@@ -0,0 +1,67 @@
+## ---------------------------------------------
+# Level control of a gravity drained tank.
+# Find the inflow profile which keeps the level close to a setpoint, starting from the tank of
+# Example 32.2 in Himmelblau, D. M., & Riggs, J. B. (2006). Basic principles and calculations in chemical engineering. FT press.
+## ---------------------------------------------
+##-- Workaround to make the cacao library in path if it's not installed but in parent directory
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..','..','..')))
+##--
+
+# imports
+import numpy as np
+import matplotlib.pyplot as plt
+
+from cacao import Composite, OptimizationProblem
+from cacao.components import Tank, Orifice, Stream, Material, Content
+
+def generate_model():
+    model = Composite()
+    model.time = np.linspace(0, 8e4, 50)
+
+    # some constants
+    water = Material(rho=1000)
+
+    A = 16 # m2 area of tank
+    A_orifice = 5e-4 # m2
+
+    content_tank = Content(water, volume=10*A)
+    c = 0.62
+
+    # manipulated inflow (kg/s), initially closed
+    model.inflow = Stream(model.time, 0.0)
+
+    # tank and orifice models
+    model.tank1 = Tank( model.time, A, content_tank)
+    model.orifice = Orifice(model.time, A_orifice, c)
+
+    model.connect(model.inflow, model.tank1)
+    model.connect(model.tank1, model.orifice)
+
+    return model
+
+model = generate_model()
+
+setpoint = 8.0 # m
+
+def objective(model):
+    # tracking error plus a small penalty on the inflow
+    error = model.tank1.height() - setpoint
+    return np.mean(error**2) + 1e-3*np.mean(model.inflow.mass_flow_rate()**2)
+
+opt = OptimizationProblem(model, objective, [model.inflow.mass_flow_rate], bounds=[(0.0, 5.0)])
+
+result = opt.run(verbose=True)
+
+fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True)
+ax1.plot(model.time, model.tank1.height(), 'b', label='height')
+ax1.plot(model.time, setpoint*np.ones_like(model.time), '--r', label='setpoint')
+ax1.set_ylabel('height (m)')
+ax1.legend()
+ax1.grid()
+ax2.step(model.time, model.inflow.mass_flow_rate(), 'k', where='post')
+ax2.set_xlabel('time (s)')
+ax2.set_ylabel('inflow (kg/s)')
+ax2.grid()
+plt.show()
@@ -1,9 +1,46 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
 import unittest
+from unittest import mock
 
 import numpy as np
 
-from cacao import Composite, SimulationProblem
-from cacao.components import Tank, Orifice, Material, Content
+from cacao import Composite, SimulationProblem, OptimizationProblem
+from cacao.components import Tank, Orifice, Stream, Material, Content
+from cacao.components.generics import Block, Variable, Constraint
+from cacao.compiled import CompiledModel, fingerprint
+
+def generate_model(n_steps=50, inflow=None):
+    # gravity drained tank, fed by a stream when an inflow (kg/s) is given
+    model = Composite()
+    model.time = np.linspace(0, 8e4, n_steps)
+
+    water = Material(rho=1000)
+    if inflow is not None:
+        model.inflow = Stream(model.time, inflow)
+    model.tank1 = Tank(model.time, 16, Content(water, volume=10*16))
+    model.orifice = Orifice(model.time, 5e-4, 0.62)
+    if inflow is not None:
+        model.connect(model.inflow, model.tank1)
+    model.connect(model.tank1, model.orifice)
+
+    return model
+
+def _indexed_rule(block):
+    return block.y()[block.i] - 2.0*block.y()[0]
+
+class _IndexedBlock(Block):
+    # a block parametrized by a plain attribute read by its constraint
+    def __init__(self, i):
+        super().__init__()
+        self.i = i
+        self.y = Variable([0, 1, 2])
+        self.y[0] = 1.0
+        self.eq1 = Constraint(_indexed_rule)
+        self.eq2 = Constraint(lambda block: block.y()[1] + block.y()[2] - 5.0)
 
 class TestUtils(unittest.TestCase):
     def test_tank(self):
@@ -18,6 +55,14 @@ class TestUtils(unittest.TestCase):
 
         self.assertEqual(tank1.area, A)
     
+    def test_empty_composite(self):
+        model = Composite()
+        bounds = model.get_bounds()
+
+        self.assertEqual(len(bounds.lb), 0)
+        self.assertEqual(len(bounds.ub), 0)
+        self.assertEqual(len(model.get_initial_guess()), 0)
+    
     def test_draining(self):
 
 
@@ -75,5 +120,226 @@ class TestUtils(unittest.TestCase):
 
         self.assertTrue(MSE<1e-2)
 
+    def test_optimization(self):
+        model = generate_model(inflow=2.0)
+
+        # reach 5 m at the end of the horizon
+        objective = lambda model: (model.tank1.height()[-1] - 5.0)**2
+        opt = OptimizationProblem(model, objective, [model.inflow.mass_flow_rate], bounds=[(0.0, None)])
+
+        # adjoint gradient against finite differences
+        u = opt.get_controls()
+        f, grad = opt.evaluate(u)
+        for i in [10, 49]:
+            u_pert = u.copy()
+            u_pert[i] += 1e-3
+            grad_fd = (opt.evaluate(u_pert)[0] - f)/1e-3
+            self.assertAlmostEqual(grad[i], grad_fd, places=4)
+
+        # evaluate returns the objective itself when maximizing
+        opt_max = OptimizationProblem(model, lambda model: -objective(model), [model.inflow.mass_flow_rate],
+                                      sense='maximize')
+        f_max, grad_max = opt_max.evaluate(u)
+        self.assertAlmostEqual(f_max, -f)
+        self.assertTrue(np.allclose(grad_max, -grad))
+
+        result = opt.run()
+
+        self.assertTrue(result.success)
+        self.assertAlmostEqual(model.tank1.height()[-1], 5.0, places=3)
+
+    def test_sensitivities(self):
+        model = generate_model()
+        sim = SimulationProblem(model)
+        sim.run(method='newton')
+        height = model.tank1.height().copy()
+
+        sens = sim.sensitivities([model.orifice.c])
+
+        # compare with a perturbed simulation
+        model.orifice.c.value = 0.62 + 1e-5
+        sim.run(method='newton')
+        sens_fd = (model.tank1.height() - height)/1e-5
+
+        self.assertEqual(sens[model.tank1.height].shape, (50, 1))
+        self.assertTrue(np.allclose(sens[model.tank1.height][:, 0], sens_fd, rtol=1e-3, atol=1e-4))
+
+    def test_compiled_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = []
+            for i in range(2):
+                model = generate_model()
+                sim = SimulationProblem(model, cache_dir=cache_dir)
+                if i == 0:
+                    result = sim.run(method='newton')
+                else:
+                    # the second run loads the structure from the cache
+                    with mock.patch.object(CompiledModel, 'from_model', side_effect=AssertionError('not cached')):
+                        result = sim.run(method='newton')
+                self.assertTrue(result.success)
+                results.append(result.x)
+
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertTrue(np.allclose(results[0], results[1]))
+
+    def test_nested_composites(self):
+        water = Material(rho=1000)
+        time_vec = np.linspace(0, 8e4, 50)
+
+        def generate_catchment():
+            catchment = Composite()
+            catchment.tank1 = Tank(time_vec, 16, Content(water, volume=10*16))
+            catchment.orifice = Orifice(time_vec, 5e-4, 0.62)
+            catchment.connect(catchment.tank1, catchment.orifice)
+            return catchment
+
+        model = Composite()
+        model.time = time_vec
+        model.upstream = generate_catchment()
+        model.downstream = generate_catchment()
+        model.connect(model.upstream.orifice, model.downstream.tank1)
+        # blocks added to a composite after it has been attached are part of the model
+        model.upstream.inflow = Stream(time_vec, 1.0)
+        model.connect(model.upstream.inflow, model.upstream.tank1)
+
+        self.assertEqual(len(model.variables), 6)
+        self.assertEqual(len(model.constraints), 6)
+        self.assertEqual(len(model.get_initial_guess()), 6*50)
+
+        sim = SimulationProblem(model)
+        result = sim.run(method='newton')
+        self.assertTrue(result.success)
+
+        index = model.get_index(model.downstream.tank1.height)
+        self.assertTrue(np.allclose(result.x[index], model.downstream.tank1.height()))
+
+        # a nested composite refers to the whole model
+        upstream = model.upstream
+        self.assertEqual(len(upstream.get_initial_guess()), 6*50)
+        self.assertEqual(len(upstream.get_bounds().lb), 6*50)
+        self.assertEqual(len(upstream.get_constraints()), 6)
+        self.assertEqual(len(upstream.get_residuals(result.x)), len(model.get_residuals(result.x)))
+        self.assertTrue(np.allclose(upstream.get_initial_guess(), result.x))
+
+        result = SimulationProblem(upstream).run(method='newton')
+        self.assertTrue(result.success)
+        self.assertTrue(np.allclose(result.x[index], model.downstream.tank1.height()))
+
+    def test_compiled_structure_changes(self):
+
+        def generate_equations(i):
+            model = Composite()
+            eqs = Block()
+            eqs.y = Variable([0, 1, 2])
+            eqs.y[0] = 1.0
+            eqs.eq1 = Constraint(lambda block: block.y()[i] - 2.0*block.y()[0])
+            eqs.eq2 = Constraint(lambda block: block.y()[1] + block.y()[2] - 5.0)
+            model.eqs = eqs
+            return model
+
+        # models differing only by an index in a constraint must not share a cache entry
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for i in (1, 2):
+                model = generate_equations(i)
+                result = SimulationProblem(model, cache_dir=cache_dir).run(method='newton')
+                self.assertTrue(result.success)
+                self.assertAlmostEqual(model.eqs.y()[i], 2.0)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        # fixing another variable recompiles the model
+        model = generate_equations(1)
+        sim = SimulationProblem(model)
+        sim.run(method='newton')
+        model.eqs.y[0] = (None, None)
+        model.eqs.y[2] = 4.0
+        result = sim.run(method='newton')
+        self.assertTrue(result.success)
+        self.assertTrue(np.allclose(model.eqs.y(), [0.5, 1.0, 4.0]))
+
+    def test_compiled_block_attributes(self):
+        # blocks differing only by an attribute read by their constraints must not share a cache entry
+        models = []
+        for i in (1, 2):
+            model = Composite()
+            model.eqs = _IndexedBlock(i)
+            models.append(model)
+        self.assertNotEqual(fingerprint(models[0]), fingerprint(models[1]))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for i, model in zip((1, 2), models):
+                result = SimulationProblem(model, cache_dir=cache_dir).run(method='newton')
+                self.assertTrue(result.success)
+                self.assertAlmostEqual(model.eqs.y()[i], 2.0)
+
+        # a cached file with the wrong sparsity pattern is detected and computed again
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch('cacao.compiled.fingerprint', return_value='same'):
+            for i in (1, 2):
+                model = Composite()
+                model.eqs = _IndexedBlock(i)
+                result = SimulationProblem(model, cache_dir=cache_dir).run(method='newton')
+                self.assertTrue(result.success)
+                self.assertAlmostEqual(model.eqs.y()[i], 2.0)
+            self.assertEqual(os.listdir(cache_dir), ['same.npz'])
+
+    def test_run_async(self):
+        async def simulate():
+            results = await asyncio.gather(*(SimulationProblem(generate_model()).run_async(method='newton')
+                                             for i in range(3)))
+            partial = await SimulationProblem(generate_model()).run_async(timeout=0.0)
+
+            cancel = threading.Event()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(SimulationProblem(generate_model()).run_async(cancel=cancel), 0.05)
+            self.assertTrue(cancel.is_set())
+
+            with ProcessPoolExecutor(1) as pool:
+                sim = SimulationProblem(generate_model())
+                in_process = await sim.run_async(pool, method='newton')
+            self.assertTrue(in_process.success)
+            # the model of the caller holds the solution computed by the worker
+            self.assertTrue(np.allclose(sim.model.get_residuals(sim.x), 0.0, atol=1e-8))
+            self.assertTrue(np.allclose(sim.model.get_initial_guess(), in_process.x))
+
+            return results, partial
+
+        results, partial = asyncio.run(simulate())
+
+        self.assertTrue(all(result.success for result in results))
+        self.assertFalse(partial.success)
+        self.assertTrue(partial.timed_out)
+        self.assertEqual(len(partial.x), 150)
+
+    def test_threaded_residuals(self):
+        water = Material(rho=1000)
+
+        model = Composite()
+        model.time = np.linspace(0, 8e4, 50)
+        for i in range(4):
+            tank = Tank(model.time, 16, Content(water, volume=(i+10)*16))
+            orifice = Orifice(model.time, 5e-4, 0.62)
+            setattr(model, f'tank{i}', tank)
+            setattr(model, f'orifice{i}', orifice)
+            model.connect(tank, orifice)
+
+        x = np.linspace(1.0, 2.0, len(model.get_initial_guess()))
+        resid = model.get_residuals(x)
+
+        model.set_threads(3)
+        self.assertTrue(np.array_equal(model.get_residuals(x), resid))
+
+        result = SimulationProblem(model).run(method='newton')
+        self.assertTrue(result.success)
+
+        # the default solver evaluates the model on the thread pool as well
+        result = SimulationProblem(model).run(x0=result.x)
+        self.assertTrue(result.max_residual < 1e-4)
+
+        # replacing or dropping the thread pool shuts down the one created by the model
+        executor = model._executor
+        model.set_threads(1)
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+        self.assertTrue(np.allclose(model.get_residuals(result.x), 0.0, atol=1e-4))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file